@@ -1,15 +1,38 @@
-from flask import Flask, jsonify
+from flask import Flask, Response, g, has_app_context
 from flask_cors import CORS
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+import redis
+import csv
+import hashlib
+import io
+import orjson
+import os
+import threading
 import time
-from datetime import datetime, timedelta
-import random
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+import numpy as np
 
 app = Flask(__name__)
 CORS(app)
 
+# One session for all AWS clients; the pool is sized for parallel dashboard queries plus
+# status polls, and adaptive retries back off when Athena throttles us
+aws_session = boto3.session.Session(region_name='ap-south-1')
+AWS_MAX_POOL_CONNECTIONS = 50
+aws_config = Config(
+    max_pool_connections=AWS_MAX_POOL_CONNECTIONS,
+    retries={'max_attempts': 5, 'mode': 'adaptive'},
+    tcp_keepalive=True
+)
+
 # Athena client
-athena = boto3.client('athena', region_name='ap-south-1')
+athena = aws_session.client('athena', config=aws_config)
+
+# S3 client for downloading Athena result files directly
+s3 = aws_session.client('s3', config=aws_config)
 
 # NOTE: These values were originally connected to AWS during development.
 # They are now placeholders so that credentials and internal resources
@@ -18,257 +41,746 @@ athena = boto3.client('athena', region_name='ap-south-1')
 DATABASE = 'your_database_name_here'
 OUTPUT_S3 = 's3://your-output-bucket-here/'
 
-# Track acknowledged alerts to prevent re-popup
-acknowledged_alerts = set()
+# Dedicated workgroup (Athena engine v3, needed for result reuse) so dashboard
+# queries don't compete with other workloads in "primary"
+WORKGROUP = os.environ.get('ATHENA_WORKGROUP', 'iot_dashboard')
+
+# Result columns Athena returns as numbers; anything else (device, device_id, alert_key) stays text
+NUMERIC_COLS = {
+    'co', 'smoke', 'temp', 'humidity', 'lpg', 'ts',
+    'avg_co', 'avg_smoke', 'avg_temp',
+    'max_co', 'max_smoke', 'max_temp',
+    'co_alerts', 'count', 'bucket',
+}
+
+# Rows per get_query_results page (the API maximum)
+RESULT_PAGE_SIZE = 1000
+
+# Athena status polling backoff (seconds)
+POLL_INITIAL_DELAY = 0.15
+POLL_MAX_DELAY = 1.0
+
+# Simulated CO trend: Tent 1 first, then Tent 2 & 3
+CO_TREND_DEVICES = ["b8:27:eb:bf:9d:51", "00:0f:00:70:91:0a", "1c:bf:ce:15:ec:4d"]
+CO_TREND_MINUTES = 50
+CO_TREND_REFRESH_SECONDS = 60  # how long one simulated trend is served before regenerating (also its RNG seed period)
+
+# Redis holds state shared by every worker: the Athena response cache and acknowledged alerts
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+# Short timeouts so a hung Redis fails fast and requests fall through to Athena
+redis_client = redis.Redis.from_url(
+    REDIS_URL,
+    decode_responses=True,
+    socket_connect_timeout=0.5,
+    socket_timeout=0.5
+)
+
+# Queries started through /query/start live under "athena_query:<id>" so any worker can serve
+# their status/results polls; Redis expires them after SUBMITTED_QUERY_MAX_AGE seconds
+SUBMITTED_QUERY_PREFIX = 'athena_query:'
+SUBMITTED_QUERY_MAX_AGE = 600
+
+# Track acknowledged alerts to prevent re-popup (Redis set, forgotten after a day)
+ACK_KEY = 'acknowledged_alerts'
+ACK_TTL_SECONDS = 86400
+
+# Freshness window (seconds) for each cache policy
+CACHE_POLICIES = {
+    'short': 5,    # live readings
+    'normal': 20,  # alert counters
+    'long': 45,    # full-table aggregations
+}
+CACHE_BUFFER_SECONDS = 2
+
+# Single-flight lock per cache key while one caller refreshes it; outlives run_query's
+# 30 s wait plus the result download so waiters never give up before the owner does
+MISS_LOCK_PREFIX = 'lock:'
+MISS_LOCK_TIMEOUT = 45
+
+# Max age (minutes) of an Athena-side reused result for each policy; live readings never reuse
+RESULT_REUSE_MINUTES = {
+    'short': None,
+    'normal': 1,
+    'long': 60,
+}
+
+
+def cache_key(query):
+    """Redis key for an Athena query (hash of the SQL text)."""
+    return "athena:" + hashlib.sha1(query.encode('utf-8')).hexdigest()
+
+
+def set_cache_status(status):
+    """Remember how the current request was served, for the X-Cache header."""
+    if has_app_context():
+        g.cache_status = status
+
+
+def read_fresh(key):
+    """Return (fresh rows or None, cache entry) for a cache key."""
+    entry = redis_client.hgetall(key)
+    if entry and float(entry['stale_at']) > time.time():
+        return orjson.loads(entry['body_json']), entry
+    return None, entry
+
+
+def wait_for_refresh(key, lock_name, previous):
+    """Wait for another thread/worker's run of the same query to land in the cache.
+
+    Returns the new rows, or None if that run finished without storing a result.
+    """
+    previous_at = float(previous['generated_at']) if previous else 0.0
+    deadline = time.time() + MISS_LOCK_TIMEOUT
+    delay = POLL_INITIAL_DELAY
+    try:
+        while time.time() < deadline:
+            time.sleep(delay)
+            delay = min(delay * 2, POLL_MAX_DELAY)
+            # Check the lock before the entry: the owner stores its result before releasing
+            lock_held = redis_client.exists(lock_name)
+            generated_at, body = redis_client.hmget(key, 'generated_at', 'body_json')
+            if generated_at is not None and float(generated_at) > previous_at:
+                return orjson.loads(body)
+            if not lock_held:
+                return None
+    except redis.RedisError as e:
+        print(f"⚠️ Redis read error: {str(e)}")
+    return None
+
+
+def cached_query(query, policy='normal'):
+    """Serve an Athena query from Redis while fresh, otherwise run it and cache the result.
+
+    Misses are single-flight: one caller per query runs it on Athena while
+    concurrent callers (in any worker) wait for its result to land in the cache.
+    """
+    key = cache_key(query)
+    entry = {}
+    lock = redis_client.lock(MISS_LOCK_PREFIX + key, timeout=MISS_LOCK_TIMEOUT)
+    try:
+        data, entry = read_fresh(key)
+        if data is not None:
+            set_cache_status('hit')
+            return data
+        owner = lock.acquire(blocking=False)
+        if owner:
+            # Someone may have refreshed it between our read and taking the lock
+            data, entry = read_fresh(key)
+            if data is not None:
+                lock.release()
+                set_cache_status('hit')
+                return data
+    except redis.RedisError as e:
+        print(f"⚠️ Redis read error: {str(e)}")
+        owner = None  # No Redis: run the query without coordination
+
+    if owner is False:
+        data = wait_for_refresh(key, lock.name, entry)
+        if data is not None:
+            set_cache_status('hit')
+            return data
+        data = {"error": "Concurrent run of this query failed"}
+    else:
+        try:
+            started = time.time()
+            data = run_query(query, reuse_minutes=RESULT_REUSE_MINUTES[policy])
+            completed_at = time.time()
+            if not is_error(data):
+                store_cached(query, policy, data, completed_at, completed_at - started)
+                set_cache_status('miss')
+                return data
+        finally:
+            if owner:
+                try:
+                    lock.release()
+                except redis.RedisError as e:
+                    print(f"⚠️ Redis lock error: {str(e)}")
+
+    # Athena is down or throttled: fall back to the last known result, however old
+    if entry:
+        print(f"♻️ Serving stale cached result from {entry['generated_at']}")
+        set_cache_status('stale')
+        return orjson.loads(entry['body_json'])
+    return data
+
+
+# Write a cache entry unless the stored one was generated at the same time or later
+# (KEYS[1] = cache key; ARGV = generated_at, stale_at, body_json)
+STORE_IF_NEWER = redis_client.register_script("""
+local current = redis.call('HGET', KEYS[1], 'generated_at')
+if current and tonumber(current) >= tonumber(ARGV[1]) then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'generated_at', ARGV[1], 'stale_at', ARGV[2], 'body_json', ARGV[3])
+return 1
+""")
+
+
+def store_cached(query, policy, data, completed_at, runtime):
+    """Cache an Athena result that finished at completed_at after running for runtime seconds."""
+    # Slow queries get a proportionally longer TTL so a result isn't stale the moment it lands
+    stale_at = completed_at + CACHE_POLICIES[policy] + runtime + CACHE_BUFFER_SECONDS
+    try:
+        # No Redis expiry: stale entries are kept as a fallback for Athena outages
+        STORE_IF_NEWER(keys=[cache_key(query)], args=[completed_at, stale_at, orjson.dumps(data)])
+    except redis.RedisError as e:
+        print(f"⚠️ Redis write error: {str(e)}")
+
+
+def start_query(query, reuse_minutes=None):
+    """Submit an Athena query and return its QueryExecutionId without waiting.
+
+    If reuse_minutes is set, Athena may answer from a previous identical query up to that old.
+    """
+    params = {
+        'QueryString': query,
+        'QueryExecutionContext': {'Database': DATABASE},
+        'ResultConfiguration': {'OutputLocation': OUTPUT_S3},
+        'WorkGroup': WORKGROUP,
+    }
+    if reuse_minutes:
+        params['ResultReuseConfiguration'] = {
+            'ResultReuseByAgeConfiguration': {'Enabled': True, 'MaxAgeInMinutes': reuse_minutes}
+        }
+    response = athena.start_query_execution(**params)
+    return response['QueryExecutionId']
+
 
-def run_query(query, max_wait_seconds=30):
+def get_query_status(query_id):
+    """Return (state, reason, output_location, completion) for an Athena query.
+
+    completion is (completed_at epoch seconds, runtime seconds) as timed by Athena,
+    or None while the query is still running.
+    """
+    status_response = athena.get_query_execution(QueryExecutionId=query_id)
+    execution = status_response['QueryExecution']
+    status = execution['Status']
+    output_location = execution.get('ResultConfiguration', {}).get('OutputLocation')
+    completion = None
+    if 'CompletionDateTime' in status:
+        completed = status['CompletionDateTime']
+        completion = (completed.timestamp(), (completed - status['SubmissionDateTime']).total_seconds())
+    return status['State'], status.get('StateChangeReason', 'Unknown'), output_location, completion
+
+
+def to_float(value):
+    """Parse a numeric result cell; Athena writes NULL as an empty/missing value."""
+    return float(value) if value else 0.0
+
+
+def keep_value(value):
+    return value
+
+
+def parse_rows(headers, rows):
+    """Turn raw string rows into dicts, converting numeric columns to float."""
+    # Numeric columns become floats (NULL -> 0.0); identifiers stay strings.
+    # Pick each column's converter once instead of per cell.
+    columns = [(h, to_float if h in NUMERIC_COLS else keep_value) for h in headers]
+    return [
+        {header: convert(value) for (header, convert), value in zip(columns, row)}
+        for row in rows
+    ]
+
+
+def read_result_csv(output_location):
+    """Download an Athena result CSV from S3 in one request and return (headers, rows)."""
+    location = urlparse(output_location)
+    obj = s3.get_object(Bucket=location.netloc, Key=location.path.lstrip('/'))
+    reader = csv.reader(io.StringIO(obj['Body'].read().decode('utf-8')))
+    headers = next(reader, None)
+    return headers, list(reader)
+
+
+def read_result_api(query_id):
+    """Read Athena results through get_query_results (all pages) and return (headers, rows)."""
+    paginator = athena.get_paginator('get_query_results')
+    pages = paginator.paginate(
+        QueryExecutionId=query_id,
+        PaginationConfig={'PageSize': RESULT_PAGE_SIZE}
+    )
+    headers = None
+    rows = []
+    for page in pages:
+        for row in page['ResultSet']['Rows']:
+            values = [cell.get('VarCharValue') for cell in row['Data']]
+            # The first row of the first page holds the column names
+            if headers is None:
+                headers = values
+            else:
+                rows.append(values)
+    return headers, rows
+
+
+def fetch_results(query_id, output_location=None):
+    """Fetch the rows of a finished Athena query as a list of dicts.
+
+    Reads the result CSV straight from S3, falling back to get_query_results
+    if the object can't be read (e.g. missing s3:GetObject permission).
+    """
+    headers = None
+    if output_location:
+        try:
+            headers, rows = read_result_csv(output_location)
+        except ClientError as e:
+            print(f"⚠️ Could not read Athena result from S3, using get_query_results: {str(e)}")
+    if headers is None:
+        headers, rows = read_result_api(query_id)
+
+    if not rows:
+        print("📭 Athena returned no data rows")
+        return [] 
+
+    data = parse_rows(headers, rows)
+    print(f"✅ Athena returned {len(data)} rows")
+    return data
+
+
+def run_query(query, max_wait_seconds=30, reuse_minutes=None):
     """Submit Athena query and wait for results (with timeout)."""
     try:
-        response = athena.start_query_execution(
-            QueryString=query,
-            QueryExecutionContext={'Database': DATABASE},
-            ResultConfiguration={'OutputLocation': OUTPUT_S3}
-        )
-        query_id = response['QueryExecutionId']
+        query_id = start_query(query, reuse_minutes=reuse_minutes)
 
-        waited = 0
-        while waited < max_wait_seconds:
-            status_response = athena.get_query_execution(QueryExecutionId=query_id)
-            status = status_response['QueryExecution']['Status']['State']
+        # Poll with exponential backoff so fast (reused) results aren't held back by a fixed 1s sleep
+        deadline = time.time() + max_wait_seconds
+        delay = POLL_INITIAL_DELAY
+        while True:
+            status, reason, output_location, _ = get_query_status(query_id)
             
             if status == 'SUCCEEDED':
                 break
             elif status in ['FAILED', 'CANCELLED']:
-                reason = status_response['QueryExecution']['Status'].get('StateChangeReason', 'Unknown')
                 print(f"❌ Athena query {status}: {reason}")
                 return {"error": f"Query {status}: {reason}"}
+            elif time.time() >= deadline:
+                break
             
-            time.sleep(1)
-            waited += 1
+            time.sleep(delay)
+            delay = min(delay * 2, POLL_MAX_DELAY)
 
         if status != 'SUCCEEDED':
             print(f"⏱️ Athena query timeout after {max_wait_seconds}s")
             return {"error": "Query timeout"}
 
-        # Fetch results
-        results = athena.get_query_results(QueryExecutionId=query_id)
-        rows = results['ResultSet']['Rows']
-        
-        if len(rows) <= 1:
-            print("📭 Athena returned no data rows")
-            return [] 
-            
-        headers = [h['VarCharValue'] for h in rows[0]['Data']]
-        data = []
-        for row in rows[1:]:
-            item = {}
-            for i, cell in enumerate(row['Data']):
-                value = cell.get('VarCharValue', None)
-                header = headers[i]
-                
-                # Try to convert to float first
-                try:
-                    float_val = float(value)
-                    item[header] = float_val
-                except (ValueError, TypeError):
-                    # If conversion fails...
-                    if header in ['device', 'device_id', 'alert_key']:
-                        # Keep it as a string if it's an identifier
-                        item[header] = value
-                    else:
-                        # Set to 0.0 if it's any other column (co, temp, etc.)
-                        item[header] = 0.0
-                        
-            data.append(item)
-        
-        print(f"✅ Athena returned {len(data)} rows")
-        return data
+        return fetch_results(query_id, output_location)
         
     except Exception as e:
         print(f"❌ Athena error: {str(e)}")
         return {"error": str(e)}
 
-# ------------------- API ENDPOINTS -------------------
-
-@app.route('/latest', methods=['GET'])
-def latest():
-    """Fetch the 20 latest readings per device, with a simulated 130.5 ppm alert for demo"""
-    query = """
-    WITH ranked AS (
-        SELECT 
-            device, co, smoke, temp, humidity, lpg,
-            CAST(to_unixtime(ts) AS BIGINT) as ts,
-            ROW_NUMBER() OVER (PARTITION BY device ORDER BY ts DESC) as rn
-        FROM processed
-    )
-    SELECT device, device AS device_id, co, smoke, temp, humidity, lpg, ts
-    FROM ranked
-    WHERE rn <= 20;
-    """
-    data = run_query(query)
-
-    if data and not (isinstance(data, dict) and "error" in data):
+# ------------------- QUERIES -------------------
+
+# Only rank readings from the last LATEST_WINDOW_HOURS instead of the whole history.
+# LATEST_WINDOW_ANCHOR:
+#   'now'  - (default) window ends at current_timestamp; a constant bound, so Athena can
+#            prune partitions/row groups and scan only the window. Devices that have sent
+#            nothing for longer than the window drop out of /latest.
+#   'none' - no window; rank the whole table (full scan). For replayed/historical datasets
+#            such as the Kaggle demo data, where a now()-relative window would be empty.
+LATEST_WINDOW_HOURS = 2
+LATEST_WINDOW_ANCHOR = os.environ.get('LATEST_WINDOW_ANCHOR', 'now')
+if LATEST_WINDOW_ANCHOR == 'now':
+    LATEST_WINDOW_FILTER = f"WHERE ts >= current_timestamp - INTERVAL '{LATEST_WINDOW_HOURS}' HOUR"
+elif LATEST_WINDOW_ANCHOR == 'none':
+    LATEST_WINDOW_FILTER = ""
+else:
+    raise ValueError(f"LATEST_WINDOW_ANCHOR must be 'now' or 'none', got {LATEST_WINDOW_ANCHOR!r}")
+
+LATEST_QUERY = f"""
+WITH ranked AS (
+    SELECT 
+        device, co, smoke, temp, humidity, lpg,
+        CAST(to_unixtime(ts) AS BIGINT) as ts,
+        ROW_NUMBER() OVER (PARTITION BY device ORDER BY ts DESC) as rn
+    FROM processed
+    {LATEST_WINDOW_FILTER}
+)
+SELECT device, device AS device_id, co, smoke, temp, humidity, lpg, ts
+FROM ranked
+WHERE rn <= 20;
+"""
+
+# Per-device averages, maxima and alert counts in a single scan of processed
+METRICS_ALL_QUERY = """
+SELECT device,
+       AVG(co) AS avg_co,
+       AVG(smoke) AS avg_smoke,
+       AVG(temp) AS avg_temp,
+       MAX(co) AS max_co,
+       MAX(smoke) AS max_smoke,
+       MAX(temp) AS max_temp,
+       SUM(CASE WHEN co >= 0.120 THEN 1 ELSE 0 END) AS co_alerts
+FROM processed
+GROUP BY device
+"""
+
+# Columns of METRICS_ALL_QUERY served by each per-metric endpoint
+METRIC_PROJECTIONS = {
+    'avg_metrics': ('device', 'avg_co', 'avg_smoke', 'avg_temp'),
+    'max_metrics': ('device', 'max_co', 'max_smoke', 'max_temp'),
+    'alert_counts': ('device', 'co_alerts'),
+}
+
+# Histogram buckets for the humidity/temperature charts: (lower bound, upper bound, bucket count).
+# Grouping on raw float readings would return one row per distinct value.
+# NULL readings would form a NULL bucket (parsed as bucket 0, merging with the underflow
+# bucket) and width_bucket fails on NaN, so both are filtered out.
+HUMIDITY_BUCKETS = (0, 100, 50)  # 2 %RH per bucket
+TEMP_BUCKETS = (-10, 50, 60)     # 1 °C per bucket
+
+HUMIDITY_CO_QUERY = f"""
+SELECT width_bucket(humidity, {HUMIDITY_BUCKETS[0]}, {HUMIDITY_BUCKETS[1]}, {HUMIDITY_BUCKETS[2]}) AS bucket,
+       AVG(humidity) AS humidity,
+       AVG(co) AS avg_co
+FROM processed
+WHERE humidity IS NOT NULL AND NOT is_nan(humidity)
+GROUP BY 1
+ORDER BY 1
+"""
+
+TEMP_DIST_QUERY = f"""
+SELECT width_bucket(temp, {TEMP_BUCKETS[0]}, {TEMP_BUCKETS[1]}, {TEMP_BUCKETS[2]}) AS bucket,
+       AVG(temp) AS temp,
+       COUNT(*) AS count
+FROM processed
+WHERE temp IS NOT NULL AND NOT is_nan(temp)
+GROUP BY 1
+ORDER BY 1
+"""
+
+# Everything the dashboard loads on startup: name -> (query, cache policy)
+DASHBOARD_QUERIES = {
+    'latest': (LATEST_QUERY, 'short'),
+    'metrics_all': (METRICS_ALL_QUERY, 'normal'),  # alert counts need the fresher policy
+    'humidity_co': (HUMIDITY_CO_QUERY, 'long'),
+    'temp_dist': (TEMP_DIST_QUERY, 'long'),
+}
+
+# Shared pool for running dashboard queries side by side (boto3 clients are thread-safe).
+# Misses are single-flight (see cached_query), so concurrent cold loads wait on one Athena
+# run per query rather than needing a thread each; room for two loads at once is plenty.
+# Never larger than the AWS connection pool, or urllib3 starts discarding connections.
+DASHBOARD_POOL_SIZE = min(
+    int(os.environ.get('DASHBOARD_POOL_SIZE', len(DASHBOARD_QUERIES) * 2)),
+    AWS_MAX_POOL_CONNECTIONS
+)
+query_executor = ThreadPoolExecutor(max_workers=DASHBOARD_POOL_SIZE)
+
+
+def is_error(data):
+    return isinstance(data, dict) and "error" in data
+
+
+# Simulated 130.5 ppm alert for Tent 1 (demo purposes); "ts" is stamped per request
+SIMULATED_ALERT_ROW = {
+    "device": "b8:27:eb:bf:9d:51",
+    "device_id": "b8:27:eb:bf:9d:51",
+    "co": 0.1305,  # 130.5 ppm
+    "smoke": 0.025,
+    "temp": 28.0,
+    "humidity": 40.0,
+    "lpg": 0.005,
+    "alert_key": "simulated_tent1_danger_130"
+}
+
+
+def project(rows, columns):
+    """Keep only the given columns of each row."""
+    return [{column: row[column] for column in columns} for row in rows]
+
+
+def with_simulated_alert(data):
+    """Append the simulated 130.5 ppm Tent 1 alert to /latest rows (demo purposes)"""
+    simulated_alert_row = {**SIMULATED_ALERT_ROW, "ts": int(time.time())}
+    if data and not is_error(data):
         print("✅ Using REAL Athena data for /latest (Top 20).")
-        
-        # Inject simulated 130.5 ppm alert for Tent 1 (demo purposes)
-        simulated_alert_row = {
-            "device": "b8:27:eb:bf:9d:51",
-            "device_id": "b8:27:eb:bf:9d:51",
-            "co": 0.1305,  # 130.5 ppm
-            "smoke": 0.025,
-            "temp": 28.0,
-            "humidity": 40.0,
-            "lpg": 0.005,
-            "ts": int(time.time()),
-            "alert_key": "simulated_tent1_danger_130"
-        }
         data.append(simulated_alert_row)
         print(f"   🚨 DEMO: Injected 130.5 ppm alert for Tent 1.")
         
     else:
         print("❌ No Athena data available for /latest")
         # If no real data, still provide the simulated alert
-        simulated_alert_row = {
-            "device": "b8:27:eb:bf:9d:51",
-            "device_id": "b8:27:eb:bf:9d:51",
-            "co": 0.1305,
-            "smoke": 0.025,
-            "temp": 28.0,
-            "humidity": 40.0,
-            "lpg": 0.005,
-            "ts": int(time.time()),
-            "alert_key": "simulated_tent1_danger_130"
-        }
         data = [simulated_alert_row]
         print(f"   🚨 DEMO: No real data, but injected simulated 130.5 ppm alert for Tent 1.")
 
-    return jsonify(data)
+    return data
+
+
+# ------------------- API ENDPOINTS -------------------
+
+def ojson(obj):
+    """Like flask.jsonify, but serialized with orjson."""
+    return Response(orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY), mimetype='application/json')
+
+
+@app.after_request
+def add_cache_header(response):
+    status = g.get('cache_status')
+    if status:
+        response.headers['X-Cache'] = status
+    return response
+
+
+@app.route('/latest', methods=['GET'])
+def latest():
+    """Fetch the 20 latest readings per device, with a simulated 130.5 ppm alert for demo"""
+    data = cached_query(LATEST_QUERY, policy='short')
+    return ojson(with_simulated_alert(data))
+
+
+def generate_co_trend(epoch):
+    """Simulate 50 minutes of per-minute CO readings for the three tents.
+
+    The trend is a pure function of the refresh epoch, so every worker process
+    serves the same body (and ETag) for the same CO_TREND_REFRESH_SECONDS window.
+    """
+    now = epoch * CO_TREND_REFRESH_SECONDS
+    steps = np.arange(CO_TREND_MINUTES)
+    timestamps = now - (CO_TREND_MINUTES - steps) * 60
+
+    # Per-reading uniform bounds; Tent 2 & 3 (and early Tent 1): realistic safe values
+    low = np.full((CO_TREND_MINUTES, len(CO_TREND_DEVICES)), 0.003)
+    high = np.full((CO_TREND_MINUTES, len(CO_TREND_DEVICES)), 0.008)
+    # Tent 1 escalates to DANGER (max 130.5 ppm = 0.1305)
+    rising = (steps > 30) & (steps <= 40)
+    danger = steps > 40
+    low[rising, 0], high[rising, 0] = 0.080, 0.120
+    low[danger, 0], high[danger, 0] = 0.120, 0.1305  # Max 130.5 ppm
+
+    co = np.round(np.random.default_rng(epoch).uniform(low, high), 6)
+
+    return [
+        {"ts": ts, "device": device, "co": value}
+        for ts, row in zip(timestamps.tolist(), co.tolist())
+        for device, value in zip(CO_TREND_DEVICES, row)
+    ]
+
+
+def co_trend_body():
+    """Serialized /co_trend payload and its ETag for the current CO_TREND_REFRESH_SECONDS epoch."""
+    global co_trend_cache
+    epoch = int(time.time() // CO_TREND_REFRESH_SECONDS)
+    cached_epoch, body, etag = co_trend_cache
+    if cached_epoch == epoch:
+        return body, etag
+    with co_trend_lock:
+        # Another thread may have refreshed it while we waited for the lock
+        cached_epoch, body, etag = co_trend_cache
+        if cached_epoch != epoch:
+            print("📈 Regenerating simulated CO trend for chart")
+            body = orjson.dumps(generate_co_trend(epoch), option=orjson.OPT_SERIALIZE_NUMPY)
+            etag = hashlib.sha1(body).hexdigest()
+            co_trend_cache = (epoch, body, etag)
+    return body, etag
+
+
+# Pre-serialized simulated trend: (refresh epoch, json bytes, etag)
+co_trend_cache = (None, b"", "")
+co_trend_lock = threading.Lock()
+co_trend_body()
 
 
 @app.route('/co_trend', methods=['GET'])
 def co_trend():
-    print("📈 Using simulated CO trend for chart")
-    now = datetime.utcnow()
-    devices = ["b8:27:eb:bf:9d:51", "00:0f:00:70:91:0a", "1c:bf:ce:15:ec:4d"]
-    data = []
+    """Simulated CO trend; repeat polls with a matching If-None-Match get 304 Not Modified"""
+    from flask import request
+    body, etag = co_trend_body()
+    response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.max_age = 5
+    return response.make_conditional(request)
 
-    for i in range(50):
-        timestamp = int((now - timedelta(minutes=50 - i)).timestamp())
-        
-        for device in devices:
-            # Tent 1 escalates to DANGER (max 130.5 ppm = 0.1305)
-            if device == "b8:27:eb:bf:9d:51":
-                if i > 40:
-                    base_co = random.uniform(0.120, 0.1305)  # Max 130.5 ppm
-                elif i > 30:
-                    base_co = random.uniform(0.080, 0.120)
-                else:
-                    base_co = random.uniform(0.003, 0.008)
-            else:
-                # Tent 2 & 3: realistic safe values
-                base_co = random.uniform(0.003, 0.008)
-            
-            data.append({
-                "ts": timestamp,
-                "device": device,
-                "co": round(base_co, 6)
-            })
 
-    return jsonify(data)
+@app.route('/metrics_all', methods=['GET'])
+def metrics_all():
+    """Averages, maxima and alert counts per device across entire dataset"""
+    data = cached_query(METRICS_ALL_QUERY, policy='normal')
+    
+    if not data or is_error(data):
+        print("❌ No metrics_all data available")
+        return ojson([])
+    
+    return ojson(data)
+
+
+def metrics_view(name):
+    """Serve one per-metric endpoint as a projection of the cached combined metrics"""
+    data = cached_query(METRICS_ALL_QUERY, policy='normal')
+    
+    if not data or is_error(data):
+        print(f"❌ No {name} data available")
+        return ojson([])
+    
+    return ojson(project(data, METRIC_PROJECTIONS[name]))
 
 
 @app.route('/avg_metrics', methods=['GET'])
 def avg_metrics():
     """Calculate average metrics across entire dataset"""
-    query = """
-    SELECT device,
-           AVG(co) AS avg_co,
-           AVG(smoke) AS avg_smoke,
-           AVG(temp) AS avg_temp
-    FROM processed
-    GROUP BY device
-    """
-    data = run_query(query)
-    
-    if not data or (isinstance(data, dict) and "error" in data):
-        print("❌ No avg_metrics data available")
-        return jsonify([])
-    
-    return jsonify(data)
+    return metrics_view('avg_metrics')
 
 
 @app.route('/max_metrics', methods=['GET'])
 def max_metrics():
     """Calculate maximum metrics across entire dataset"""
-    query = """
-    SELECT device,
-           MAX(co) AS max_co,
-           MAX(smoke) AS max_smoke,
-           MAX(temp) AS max_temp
-    FROM processed
-    GROUP BY device
-    """
-    data = run_query(query)
-    
-    if not data or (isinstance(data, dict) and "error" in data):
-        print("❌ No max_metrics data available")
-        return jsonify([])
-    
-    return jsonify(data)
+    return metrics_view('max_metrics')
 
 
 @app.route('/alert_counts', methods=['GET'])
 def alert_counts():
     """Count alerts across entire dataset"""
-    query = """
-    SELECT device,
-           SUM(CASE WHEN co >= 0.120 THEN 1 ELSE 0 END) AS co_alerts
-    FROM processed
-    GROUP BY device
-    """
-    data = run_query(query)
-    
-    if not data or (isinstance(data, dict) and "error" in data):
-        print("❌ No alert_counts data available")
-        return jsonify([])
-    
-    return jsonify(data)
+    return metrics_view('alert_counts')
 
 
 @app.route('/humidity_co', methods=['GET'])
 def humidity_co():
     """Analyze humidity vs CO correlation"""
-    query = """
-    SELECT humidity, AVG(co) AS avg_co
-    FROM processed
-    GROUP BY humidity
-    ORDER BY humidity
-    """
-    data = run_query(query)
+    data = cached_query(HUMIDITY_CO_QUERY, policy='long')
     
-    if not data or (isinstance(data, dict) and "error" in data):
+    if not data or is_error(data):
         print("❌ No humidity_co data available")
-        return jsonify([])
+        return ojson([])
     
-    return jsonify(data)
+    return ojson(data)
 
 
 @app.route('/temp_dist', methods=['GET'])
 def temp_dist():
     """Get temperature distribution"""
-    query = """
-    SELECT temp, COUNT(*) AS count
-    FROM processed
-    GROUP BY temp
-    ORDER BY temp
-    """
-    data = run_query(query)
+    data = cached_query(TEMP_DIST_QUERY, policy='long')
     
-    if not data or (isinstance(data, dict) and "error" in data):
+    if not data or is_error(data):
         print("❌ No temp_dist data available")
-        return jsonify([])
+        return ojson([])
     
-    return jsonify(data)
+    return ojson(data)
+
+
+@app.route('/dashboard', methods=['GET'])
+def dashboard():
+    """Run every dashboard query in parallel and return them in one payload"""
+    futures = {
+        name: query_executor.submit(cached_query, query, policy)
+        for name, (query, policy) in DASHBOARD_QUERIES.items()
+    }
+    data = {}
+    for name, future in futures.items():
+        result = future.result()
+        if not result or is_error(result):
+            print(f"❌ No {name} data available")
+            result = []
+        data[name] = result
+
+    metrics = data.pop('metrics_all')
+    for name, columns in METRIC_PROJECTIONS.items():
+        data[name] = project(metrics, columns)
+
+    data['latest'] = with_simulated_alert(data['latest'])
+    return ojson(data)
+
+
+# --- Async Query Endpoints ---
+# Start a named dashboard query, then poll its status and fetch results separately,
+# so no worker thread is held for the whole Athena run.
+
+def submitted_query(query_id):
+    """Return the dashboard query name for a query started through /query/start, or None."""
+    return redis_client.get(SUBMITTED_QUERY_PREFIX + query_id)
+
+
+def cached_since(query, completed_at):
+    """Cached rows for query if they were generated at or after completed_at, else None."""
+    try:
+        entry = redis_client.hmget(cache_key(query), 'generated_at', 'body_json')
+    except redis.RedisError as e:
+        print(f"⚠️ Redis read error: {str(e)}")
+        return None
+    generated_at, body = entry
+    if generated_at is not None and float(generated_at) >= completed_at:
+        return orjson.loads(body)
+    return None
+
+
+@app.route('/query/start', methods=['POST'])
+def query_start():
+    """Start one of the dashboard queries by name and return its query ID"""
+    from flask import request
+    name = (request.get_json(silent=True) or {}).get('name')
+    if name not in DASHBOARD_QUERIES:
+        return ojson({"error": f"Unknown query: {name}"}), 400
+
+    query, policy = DASHBOARD_QUERIES[name]
+    try:
+        query_id = start_query(query, reuse_minutes=RESULT_REUSE_MINUTES[policy])
+    except Exception as e:
+        print(f"❌ Athena error: {str(e)}")
+        return ojson({"error": str(e)}), 502
+
+    try:
+        redis_client.set(
+            SUBMITTED_QUERY_PREFIX + query_id,
+            name,
+            ex=SUBMITTED_QUERY_MAX_AGE
+        )
+    except redis.RedisError as e:
+        print(f"❌ Redis error: {str(e)}")
+        return ojson({"error": str(e)}), 503
+
+    print(f"🚀 Started {name} query {query_id}")
+    return ojson({"query_id": query_id})
+
+
+@app.route('/query/<query_id>/status', methods=['GET'])
+def query_status(query_id):
+    """Report the Athena state of a query started through /query/start"""
+    try:
+        if submitted_query(query_id) is None:
+            return ojson({"error": "Unknown query ID"}), 404
+    except redis.RedisError as e:
+        print(f"❌ Redis error: {str(e)}")
+        return ojson({"error": str(e)}), 503
+    try:
+        state, reason, _, _ = get_query_status(query_id)
+    except Exception as e:
+        print(f"❌ Athena error: {str(e)}")
+        return ojson({"error": str(e)}), 502
+
+    body = {"query_id": query_id, "state": state}
+    if state in ['FAILED', 'CANCELLED']:
+        body["reason"] = reason
+    return ojson(body)
+
+
+@app.route('/query/<query_id>/results', methods=['GET'])
+def query_results(query_id):
+    """Fetch the rows of a finished query started through /query/start"""
+    try:
+        name = submitted_query(query_id)
+    except redis.RedisError as e:
+        print(f"❌ Redis error: {str(e)}")
+        return ojson({"error": str(e)}), 503
+    if name is None:
+        return ojson({"error": "Unknown query ID"}), 404
+    query, policy = DASHBOARD_QUERIES[name]
+    try:
+        state, reason, output_location, completion = get_query_status(query_id)
+        if state != 'SUCCEEDED':
+            return ojson({"query_id": query_id, "state": state}), 409
+        completed_at, runtime = completion
+
+        # Repeat fetches, or a result /latest or /dashboard refreshed since, come from the cache
+        data = cached_since(query, completed_at)
+        if data is None:
+            data = fetch_results(query_id, output_location)
+            # Warm the same cache entry the blocking endpoints and /dashboard read from
+            store_cached(query, policy, data, completed_at, runtime)
+    except Exception as e:
+        print(f"❌ Athena error: {str(e)}")
+        return ojson({"error": str(e)}), 502
+
+    if name == 'latest':
+        data = with_simulated_alert(data)
+    return ojson(data)
 
 
 # --- Utility Endpoints ---
@@ -279,19 +791,29 @@ def acknowledge_alert():
     from flask import request
     alert_key = request.json.get('alert_key')
     if alert_key:
-        acknowledged_alerts.add(alert_key)
+        try:
+            pipe = redis_client.pipeline()
+            pipe.sadd(ACK_KEY, alert_key)
+            pipe.expire(ACK_KEY, ACK_TTL_SECONDS)
+            pipe.execute()
+        except redis.RedisError as e:
+            print(f"❌ Redis error: {str(e)}")
+            return ojson({"success": False, "error": str(e)}), 503
         print(f"✅ Alert acknowledged: {alert_key}")
-        return jsonify({"success": True, "acknowledged": alert_key})
-    return jsonify({"success": False}), 400
+        return ojson({"success": True, "acknowledged": alert_key})
+    return ojson({"success": False}), 400
 
 
 @app.route('/reset_alerts', methods=['POST'])
 def reset_alerts():
     """Reset all acknowledged alerts (for testing)"""
-    global acknowledged_alerts
-    acknowledged_alerts.clear()
+    try:
+        redis_client.delete(ACK_KEY)
+    except redis.RedisError as e:
+        print(f"❌ Redis error: {str(e)}")
+        return ojson({"success": False, "error": str(e)}), 503
     print("🔄 All alerts reset")
-    return jsonify({"success": True, "message": "All alerts reset"})
+    return ojson({"success": True, "message": "All alerts reset"})
 
 
 if __name__ == "__main__":